@@ -32,7 +32,7 @@ with warnings.catch_warnings():
 import os
 import collada
 import numpy
-import uuid
+import itertools
 import lxml
 from StringIO import StringIO
 
@@ -142,59 +142,84 @@ class ColladaReader(object):
         return d
 
     def convertchild(self, d):
-        m = None
-        if type(d) in [collada.scene.Node, collada.scene.NodeNode]:
-            m = model.MeshTransformData()
-            m.matrix = d.matrix
-            m.children = []
-            for c in d.children:
-                cc = self.convertchild(c)
-                if cc is not None:
-                    m.children.append(cc)
-        elif type(d) == collada.scene.GeometryNode:
-            m = model.MeshTransformData()
-            m.matrix = numpy.identity(4)
-            materialmap = {}
-            for mm in d.materials:
-                materialmap[mm.symbol] = self._materials[mm.target.id]
-            for p in d.geometry.primitives:
-                sm = model.MeshData()
-                if type(p) == collada.polylist.Polylist:
-                    p = p.triangleset()
-                sm.vertex = p.vertex
-                if len(p.vertex_index.shape) == 2:
-                    sm.vertex_index = p.vertex_index
-                else:
-                    sm.vertex_index = numpy.array(p.vertex_index).reshape(len(p.vertex_index)/3, 3)
-                if p.normal is not None:
-                    sm.normal = p.normal
-                    if len(p.normal_index.shape) == 2:
-                        sm.normal_index = p.normal_index
-                    else:
-                        sm.normal_index = numpy.array(p.normal_index).reshape(len(p.normal_index)/3, 3)
-                if len(p.texcoordset) > 0:
-                    sm.uvmap = p.texcoordset[0]
-                    if len(p.texcoord_indexset[0].shape) == 2:
-                        sm.uvmap_index = p.texcoord_indexset[0]
+        # traverse the scene graph with an explicit stack, each entry
+        # holds the node and the children list of its converted parent
+        ret = []
+        stack = [(d, ret)]
+        while stack:
+            d, children = stack.pop()
+            if isinstance(d, collada.scene.Node):
+                m = model.MeshTransformData()
+                m.matrix = d.matrix
+                m.children = []
+                children.append(m)
+                for c in reversed(d.children):
+                    stack.append((c, m.children))
+            elif isinstance(d, collada.scene.GeometryNode):
+                m = model.MeshTransformData()
+                m.matrix = numpy.identity(4)
+                materialmap = {}
+                for mm in d.materials:
+                    materialmap[mm.symbol] = self._materials[mm.target.id]
+                for p in d.geometry.primitives:
+                    sm = model.MeshData()
+                    if type(p) == collada.polylist.Polylist:
+                        p = p.triangleset()
+                    sm.vertex = p.vertex
+                    if len(p.vertex_index.shape) == 2:
+                        sm.vertex_index = p.vertex_index
                     else:
-                        sm.uvmap_index = numpy.array(p.texcoord_indexset[0]).reshape(len(p.texcoord_indexset[0])/3, 3)
-                try:
-                    sm.material = materialmap[p.material]
-                except KeyError:
-                    sm.material = model.MaterialModel()
-                m.children.append(sm)
-        else:
-            logging.info("skipping unsupported collada node type: " + type(d).__name__)
-        return m
+                        sm.vertex_index = numpy.array(p.vertex_index).reshape(len(p.vertex_index)/3, 3)
+                    if p.normal is not None:
+                        sm.normal = p.normal
+                        if len(p.normal_index.shape) == 2:
+                            sm.normal_index = p.normal_index
+                        else:
+                            sm.normal_index = numpy.array(p.normal_index).reshape(len(p.normal_index)/3, 3)
+                    if len(p.texcoordset) > 0:
+                        sm.uvmap = p.texcoordset[0]
+                        if len(p.texcoord_indexset[0].shape) == 2:
+                            sm.uvmap_index = p.texcoord_indexset[0]
+                        else:
+                            sm.uvmap_index = numpy.array(p.texcoord_indexset[0]).reshape(len(p.texcoord_indexset[0])/3, 3)
+                    try:
+                        sm.material = materialmap[p.material]
+                    except KeyError:
+                        sm.material = model.MaterialModel()
+                    m.children.append(sm)
+                children.append(m)
+            else:
+                logging.info("skipping unsupported collada node type: " + type(d).__name__)
+        if len(ret) > 0:
+            return ret[0]
+        return None
 
 
 class ColladaWriter(object):
     '''
     Collada writer class
+
+    Node and shape ids are numbered sequentially in each written file
+
+    >>> s = model.ShapeModel()
+    >>> s.data = model.MeshTransformData()
+    >>> mesh = model.MeshData()
+    >>> mesh.vertex = numpy.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], dtype=numpy.float32)
+    >>> mesh.vertex_index = numpy.array([[0, 1, 2]], dtype=numpy.int32)
+    >>> s.data.children = [mesh]
+    >>> w = ColladaWriter()
+    >>> for i in range(2):
+    ...     w.write(s, '/tmp/simtrans-triangle.dae')
+    ...     d = collada.Collada('/tmp/simtrans-triangle.dae')
+    ...     print [n.id for n in d.scene.nodes[0].children], [g.name for g in d.geometries]
+    ['node-0'] ['shape-0']
+    ['node-0'] ['shape-0']
     '''
     def __init__(self):
         self._mesh = None
         self._matnode = None
+        self._nodecount = None
+        self._shapecount = None
 
     def write(self, m, f, options=None):
         '''
@@ -202,6 +227,10 @@ class ColladaWriter(object):
         '''
         # we use pycollada to generate the dae file
         self._mesh = collada.Collada()
+        # sequential ids are unique inside the document and keep the
+        # output reproducible
+        self._nodecount = itertools.count()
+        self._shapecount = itertools.count()
 
         # create effect and material
         if m.data.material:
@@ -244,46 +273,65 @@ class ColladaWriter(object):
         self._mesh.write(f)
 
     def convertchild(self, m):
-        if type(m) == model.MeshTransformData:
-            children = []
-            name = 'node-' + str(uuid.uuid1()).replace('-', '')
-            for c in m.children:
-                cn = self.convertchild(c)
-                if cn:
-                    children.append(cn)
-            node = collada.scene.Node(name, children=children)
-            return node
-        elif type(m) == model.MeshData:
-            name = 'shape-' + str(uuid.uuid1()).replace('-', '')
-            vertexname = name + '-vertex'
-            normalname = name + '-normal'
-            uvmapname = name + '-uvmap'
-            sources = []
-            input_list = collada.source.InputList()
-            sources.append(collada.source.FloatSource(vertexname, m.vertex.reshape(1, m.vertex.size), ('X', 'Y', 'Z')))
-            indices = m.vertex_index.reshape(1, m.vertex_index.size)
-            input_list.addInput(0, 'VERTEX', '#' + vertexname)
-            if m.normal is not None and m.normal_index.size > 0:
-                sources.append(collada.source.FloatSource(normalname, m.normal.reshape(1, m.normal.size), ('X', 'Y', 'Z')))
-                indices = numpy.vstack([indices, m.normal_index.reshape(1, m.normal_index.size)])
-                input_list.addInput(1, 'NORMAL', '#' + normalname)
-            else:
-                d = DummyTriangleSet()
-                d._vertex = m.vertex
-                d._vertex_index = m.vertex_index
-                d.generateNormals()
-                sources.append(collada.source.FloatSource(normalname, d._normal.reshape(1, d._normal.size), ('X', 'Y', 'Z')))
-                indices = numpy.vstack([indices, d._normal_index.reshape(1, d._normal_index.size)])
-                input_list.addInput(1, 'NORMAL', '#' + normalname)
-            if m.uvmap is not None:
-                sources.append(collada.source.FloatSource(uvmapname, m.uvmap.reshape(1, m.uvmap.size), ('S', 'T')))
-                indices = numpy.vstack([indices, m.uvmap_index.reshape(1, m.uvmap_index.size)])
-                input_list.addInput(2, 'TEXCOORD', '#' + uvmapname, set="0")
-            geom = collada.geometry.Geometry(self._mesh, 'geometry0', name, sources, double_sided=True)
-            # create triangles
-            triset = geom.createTriangleSet(indices.T.reshape(1, indices.size), input_list, 'materialref')
-            geom.primitives.append(triset)
-            self._mesh.geometries.append(geom)
-            node = collada.scene.GeometryNode(geom, [self._matnode])
-            return node
-        return None
+        try:
+            converter = self._converters[type(m)]
+        except KeyError:
+            return None
+        return converter(self, m)
+
+    def convertnode(self, m):
+        children = []
+        name = 'node-%i' % next(self._nodecount)
+        for c in m.children:
+            cn = self.convertchild(c)
+            if cn:
+                children.append(cn)
+        node = collada.scene.Node(name, children=children)
+        return node
+
+    def convertmesh(self, m):
+        name = 'shape-%i' % next(self._shapecount)
+        vertexname = name + '-vertex'
+        normalname = name + '-normal'
+        uvmapname = name + '-uvmap'
+        sources = []
+        input_list = collada.source.InputList()
+        # sources are passed in their own precision (float32 meshes from
+        # the VRML reader are written as is, float64 ones are not rounded)
+        sources.append(collada.source.FloatSource(vertexname, m.vertex.ravel(), ('X', 'Y', 'Z')))
+        # interleave vertex/normal(/uvmap) indices per triangle corner
+        # into a single C-contiguous buffer (no stack and transpose copies)
+        ninputs = 2
+        if m.uvmap is not None:
+            ninputs = 3
+        indices = numpy.empty((m.vertex_index.size, ninputs), dtype=numpy.int32)
+        indices[:, 0] = m.vertex_index.ravel()
+        input_list.addInput(0, 'VERTEX', '#' + vertexname)
+        if m.normal is not None and m.normal_index.size > 0:
+            sources.append(collada.source.FloatSource(normalname, m.normal.ravel(), ('X', 'Y', 'Z')))
+            indices[:, 1] = m.normal_index.ravel()
+            input_list.addInput(1, 'NORMAL', '#' + normalname)
+        else:
+            d = DummyTriangleSet()
+            d._vertex = m.vertex
+            d._vertex_index = m.vertex_index
+            d.generateNormals()
+            sources.append(collada.source.FloatSource(normalname, d._normal.ravel(), ('X', 'Y', 'Z')))
+            indices[:, 1] = d._normal_index.ravel()
+            input_list.addInput(1, 'NORMAL', '#' + normalname)
+        if m.uvmap is not None:
+            sources.append(collada.source.FloatSource(uvmapname, m.uvmap.ravel(), ('S', 'T')))
+            indices[:, 2] = m.uvmap_index.ravel()
+            input_list.addInput(2, 'TEXCOORD', '#' + uvmapname, set="0")
+        geom = collada.geometry.Geometry(self._mesh, 'geometry0', name, sources, double_sided=True)
+        # create triangles
+        triset = geom.createTriangleSet(indices.ravel(), input_list, 'materialref')
+        geom.primitives.append(triset)
+        self._mesh.geometries.append(geom)
+        node = collada.scene.GeometryNode(geom, [self._matnode])
+        return node
+
+    _converters = {
+        model.MeshTransformData: convertnode,
+        model.MeshData: convertmesh
+    }
@@ -26,7 +26,42 @@ class ProjectModel(object):
         self.bodies = []
 
 
-class TransformationModel(object):
+class SlotsModel(object):
+    """
+    Base class for models with __slots__
+
+    Provides the state of both slots and __dict__ so that the models
+    (and their subclasses) can be pickled with any protocol
+
+    >>> import pickle
+    >>> m = MeshTransformData()
+    >>> m.children = [MeshData()]
+    >>> m2 = pickle.loads(pickle.dumps(m))
+    >>> type(m2.children[0]).__name__
+    'MeshData'
+    >>> j = JointModel()
+    >>> j.name = 'joint0'
+    >>> pickle.loads(pickle.dumps(j)).name
+    'joint0'
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for k in cls.__dict__.get('__slots__', ()):
+                if hasattr(self, k):
+                    state[k] = getattr(self, k)
+        if hasattr(self, '__dict__'):
+            state.update(self.__dict__)
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+
+class TransformationModel(SlotsModel):
     """
     Transformation model with utility methods
 
@@ -44,16 +79,13 @@ class TransformationModel(object):
     >>> numpy.allclose(m.getangle()[1], 0)
     True
     """
-    matrix = None     #: Transformation matrix (4x4 numpy matrix)
-    trans = None      #: Translation vector (3-dim numpy array)
-    scale = None      #: Scale vector (3-dim numpy array)
-    rot = None        #: Rotation (4-dim numpy array in quaternion representation)
+    __slots__ = ('matrix', 'trans', 'scale', 'rot')
 
     def __init__(self):
-        self.matrix = None
-        self.trans = numpy.array([0, 0, 0])
-        self.scale = numpy.array([1, 1, 1])
-        self.rot = numpy.array([1, 0, 0, 0])
+        self.matrix = None                     #: Transformation matrix (4x4 numpy matrix)
+        self.trans = numpy.array([0, 0, 0])    #: Translation vector (3-dim numpy array)
+        self.scale = numpy.array([1, 1, 1])    #: Scale vector (3-dim numpy array)
+        self.rot = numpy.array([1, 0, 0, 0])   #: Rotation (4-dim numpy array in quaternion representation)
 
     def isvalid(self):
         valid = True
@@ -444,11 +476,12 @@ class MeshTransformData(TransformationModel):
 
     Intended to store scenegraph structure inside collada or vrml
     """
-    children = []      #: Children (store MeshData or MeshTransformData)
+    __slots__ = ('children', 'material')
 
     def __init__(self):
         TransformationModel.__init__(self)
-        self.children = []
+        self.children = []     #: Children (store MeshData or MeshTransformData)
+        self.material = None   #: Material of the whole mesh (e.g. given in sdf)
 
     def maxv(self, trans=None):
         mv = numpy.array([-numpy.Inf, -numpy.Inf, -numpy.Inf, -numpy.Inf])
@@ -515,23 +548,23 @@ class MeshTransformData(TransformationModel):
         self.matrix = numpy.identity(4)
 
 
-class MeshData(object):
+class MeshData(SlotsModel):
     """
     Mesh data
     """
-    vertex = []          #: Vertex position ([x,y,z] * N numpy matrix)
-    vertex_index = []    #: Vertex index  ([p1,p2,p3] * N numpy matrix)
-    normal = None        #: Normal direction ([x,y,z] * N numpy matrix)
-    normal_index = None  #: Normal index  ([p1,p2,p3] * N numpy matrix)
-    color = None         #: Color ([R,G,B,A] * N numpy matrix)
-    color_index = None   #: Color index  ([p1,p2,p3] * N numpy matrix)
-    uvmap = None         #: UV mapping ([u,v] * N numpy matrix)
-    uvmap_index = None   #: Vertex index  ([p1,p2,p3] * N numpy matrix)
-    material = None      #: Name of material
+    __slots__ = ('vertex', 'vertex_index', 'normal', 'normal_index',
+                 'color', 'color_index', 'uvmap', 'uvmap_index', 'material')
 
     def __init__(self):
-        self.vertex = []
-        self.vertex_index = []
+        self.vertex = []           #: Vertex position ([x,y,z] * N numpy matrix)
+        self.vertex_index = []     #: Vertex index  ([p1,p2,p3] * N numpy matrix)
+        self.normal = None         #: Normal direction ([x,y,z] * N numpy matrix)
+        self.normal_index = None   #: Normal index  ([p1,p2,p3] * N numpy matrix)
+        self.color = None          #: Color ([R,G,B,A] * N numpy matrix)
+        self.color_index = None    #: Color index  ([p1,p2,p3] * N numpy matrix)
+        self.uvmap = None          #: UV mapping ([u,v] * N numpy matrix)
+        self.uvmap_index = None    #: Vertex index  ([p1,p2,p3] * N numpy matrix)
+        self.material = None       #: Name of material
 
     def getbbox(self):
         maxv = numpy.array([-numpy.Inf, -numpy.Inf, -numpy.Inf])
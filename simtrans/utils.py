@@ -7,6 +7,7 @@ Miscellaneous utility functions
 import os
 import subprocess
 import logging
+import collections
 
 
 def resolveFile(f):
@@ -95,28 +96,36 @@ def findroot(mdata):
     >>> m = r.read('model://pr2/model.sdf')
     >>> findroot(m)
     ['base_footprint']
+
+    >>> from . import model
+    >>> m = model.BodyModel()
+    >>> for (p, c) in [('world', 'base'), ('base', 'arm1'), ('base', 'arm2'), ('arm1', 'hand')]:
+    ...     j = model.JointModel()
+    ...     j.parent = p
+    ...     j.child = c
+    ...     m.joints.append(j)
+    >>> for n in ['base', 'arm1', 'arm2', 'hand', 'camera']:
+    ...     l = model.LinkModel()
+    ...     l.name = n
+    ...     m.links.append(l)
+    >>> findroot(m)
+    ['world', 'camera']
+    >>> m.joints = m.joints[1:]
+    >>> findroot(m)
+    ['base', 'camera']
     '''
-    links = {}
-    usedlinks = {}
-    for j in mdata.joints:
-        try:
-            links[j.parent] = links[j.parent] + 1
-        except KeyError:
-            links[j.parent] = 1
-        usedlinks[j.parent] = True
-        usedlinks[j.child] = True
-    for j in mdata.joints:
-        try:
-            del links[j.child]
-        except KeyError:
-            pass
-    peaks = [l[0] for l in sorted(links.items(), key=lambda x: x[1], reverse=True)]
+    links = collections.Counter(j.parent for j in mdata.joints)
+    children = set(j.child for j in mdata.joints)
+    usedlinks = children.union(links)
+    for c in children:
+        links.pop(c, None)
+    peaks = [l[0] for l in links.most_common()]
     ret = []
     for p in peaks:
         if hasopenlink(mdata, p):
             ret.append(p)
     for l in mdata.links:
-        if not usedlinks.has_key(l.name):
+        if l.name not in usedlinks:
             ret.append(l.name)
     return ret
 
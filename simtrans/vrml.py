@@ -52,8 +52,11 @@ with warnings.catch_warnings():
 import math
 import numpy
 import copy
+import functools
 import jinja2
 import uuid
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 try:
     import CORBA
     import CosNaming
@@ -73,6 +76,28 @@ def terminator():
         p.terminate()
 atexit.register(terminator)
 
+
+class TemplateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    '''
+    On-disk template bytecode cache which never fails the rendering
+
+    Older jinja2 writes the cache file non-atomically and without error
+    handling, so unreadable or partially written entries are treated as
+    cache misses and failures on writing are ignored.
+    '''
+    def load_bytecode(self, bucket):
+        try:
+            jinja2.FileSystemBytecodeCache.load_bytecode(self, bucket)
+        except (IOError, OSError, EOFError, ValueError):
+            logging.debug("unable to load template bytecode cache %s" % bucket.key)
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        try:
+            jinja2.FileSystemBytecodeCache.dump_bytecode(self, bucket)
+        except (IOError, OSError):
+            logging.debug("unable to write template bytecode cache %s" % bucket.key)
+
 class VRMLReader(object):
     '''
     VRML reader class
@@ -89,9 +114,16 @@ class VRMLReader(object):
         self._links = []
         self._linknamemap = {}
         self._linknamemap['world'] = 'world'
-        self._materials = []
+        self._materials = {}
         self._sensors = []
+        self._shapecache = {}
         self._assethandler = None
+        # unbound methods (avoid reference cycle to self)
+        self._primitivereaders = {
+            OpenHRP.SP_SPHERE: (model.ShapeModel.SP_SPHERE, VRMLReader.readSphere),
+            OpenHRP.SP_CYLINDER: (model.ShapeModel.SP_CYLINDER, VRMLReader.readCylinder),
+            OpenHRP.SP_BOX: (model.ShapeModel.SP_BOX, VRMLReader.readBox)
+        }
 
     def read(self, f, assethandler=None, options=None):
         '''
@@ -125,26 +157,15 @@ class VRMLReader(object):
         bm.name = self._model._get_name()
         self._joints = []
         self._links = []
-        self._materials = []
+        self._materials = {}
         self._sensors = []
+        self._shapecache = {}
         self._hrplinks = self._model._get_links()
         self._hrpshapes = self._model._get_shapes()
         self._hrpapperances = self._model._get_appearances()
         self._hrpmaterials = self._model._get_materials()
         self._hrptextures = self._model._get_textures()
         self._hrpextrajoints = self._model._get_extraJoints()
-        mid = 0
-        for a in self._hrpmaterials:
-            m = model.MaterialModel()
-            m.name = "material-%i" % mid
-            mid = mid + 1
-            m.ambient = a.ambientIntensity
-            m.diffuse = a.diffuseColor + [1.0]
-            m.specular = a.specularColor + [1.0]
-            m.emission = a.emissiveColor + [1.0]
-            m.shininess = a.shininess
-            m.transparency = a.transparency
-            self._materials.append(m)
         root = self._hrplinks[0]
         bm.trans = numpy.array(root.translation)
         if root.jointType == 'fixed':
@@ -234,76 +255,111 @@ class VRMLReader(object):
         for s in m.shapeIndices:
             sm = model.ShapeModel()
             sm.name = lm.name + "-shape-%i" % s.shapeIndex
-            sm.matrix = numpy.matrix(s.transformMatrix+[0, 0, 0, 1]).reshape(4, 4)
+            sm.matrix = numpy.empty((4, 4))
+            sm.matrix[:3] = numpy.reshape(s.transformMatrix, (3, 4))
+            sm.matrix[3] = [0, 0, 0, 1]
             sdata = self._hrpshapes[s.shapeIndex]
-            if sdata.primitiveType == OpenHRP.SP_MESH:
-                sm.shapeType = model.ShapeModel.SP_MESH
-                sm.data = self.readMesh(sdata)
-            elif sdata.primitiveType == OpenHRP.SP_SPHERE and numpy.allclose(sm.matrix, numpy.identity(4)):
-                sm.shapeType = model.ShapeModel.SP_SPHERE
-                sm.data = model.SphereData()
-                sm.data.radius = sdata.primitiveParameters[0]
-                sm.data.material = self._materials[sdata.appearanceIndex]
-            elif sdata.primitiveType == OpenHRP.SP_CYLINDER and numpy.allclose(sm.matrix, numpy.identity(4)):
-                sm.shapeType = model.ShapeModel.SP_CYLINDER
-                sm.data = model.CylinderData()
-                sm.data.radius = sdata.primitiveParameters[0]
-                sm.data.height = sdata.primitiveParameters[1]
-                sm.data.material = self._materials[sdata.appearanceIndex]
-            elif sdata.primitiveType == OpenHRP.SP_BOX and numpy.allclose(sm.matrix, numpy.identity(4)):
-                sm.shapeType = model.ShapeModel.SP_BOX
-                sm.data = model.BoxData()
-                sm.data.x = sdata.primitiveParameters[0]
-                sm.data.y = sdata.primitiveParameters[1]
-                sm.data.z = sdata.primitiveParameters[2]
-                sm.data.material = self._materials[sdata.appearanceIndex]
+            (shapeType, reader) = self._primitivereaders.get(sdata.primitiveType, (None, None))
+            if reader is not None and numpy.allclose(sm.matrix, numpy.identity(4)):
+                sm.shapeType = shapeType
+                sm.data = reader(self, sdata)
             else:
+                # mesh, or primitives with transformation (which cannot
+                # be expressed as primitives) are converted to mesh
                 # raise Exception('unsupported shape primitive: %s' % sdata.primitiveType)
                 sm.shapeType = model.ShapeModel.SP_MESH
-                sm.data = self.readMesh(sdata)
+                sm.data = self.readMesh(sdata, s.shapeIndex)
             lm.visuals.append(sm)
             lm.collisions.append(sm)
         return lm
 
-    def readMesh(self, sdata):
+    def getMaterial(self, idx):
+        # materials are converted on first reference (models often
+        # define materials which are not used by any shape)
+        try:
+            return self._materials[idx]
+        except KeyError:
+            pass
+        a = self._hrpmaterials[idx]
+        m = model.MaterialModel()
+        m.name = "material-%i" % idx
+        m.ambient = a.ambientIntensity
+        m.diffuse = self.readColor(a.diffuseColor)
+        m.specular = self.readColor(a.specularColor)
+        m.emission = self.readColor(a.emissiveColor)
+        m.shininess = a.shininess
+        m.transparency = a.transparency
+        self._materials[idx] = m
+        return m
+
+    def readColor(self, color):
+        # convert rgb to rgba array
+        rgba = numpy.empty(4, dtype=numpy.float32)
+        rgba[:3] = color
+        rgba[3] = 1.0
+        return rgba
+
+    def readSphere(self, sdata):
+        data = model.SphereData()
+        data.radius = sdata.primitiveParameters[0]
+        data.material = self.getMaterial(sdata.appearanceIndex)
+        return data
+
+    def readCylinder(self, sdata):
+        data = model.CylinderData()
+        data.radius = sdata.primitiveParameters[0]
+        data.height = sdata.primitiveParameters[1]
+        data.material = self.getMaterial(sdata.appearanceIndex)
+        return data
+
+    def readBox(self, sdata):
+        data = model.BoxData()
+        data.x = sdata.primitiveParameters[0]
+        data.y = sdata.primitiveParameters[1]
+        data.z = sdata.primitiveParameters[2]
+        data.material = self.getMaterial(sdata.appearanceIndex)
+        return data
+
+    def readMesh(self, sdata, shapeIndex=None):
+        # same shape can be referenced from multiple links (symmetric
+        # limbs, wheels etc.), share the mesh data between them
+        if shapeIndex is not None:
+            try:
+                return self._shapecache[shapeIndex]
+            except KeyError:
+                pass
         data = model.MeshData()
-        data.vertex = numpy.array(sdata.vertices).reshape(len(sdata.vertices)/3, 3)
-        data.vertex_index = numpy.array(sdata.triangles).reshape(len(sdata.triangles)/3, 3)
+        data.vertex = numpy.fromiter(sdata.vertices, dtype=numpy.float32, count=len(sdata.vertices)).reshape(-1, 3)
+        data.vertex_index = numpy.fromiter(sdata.triangles, dtype=numpy.int32, count=len(sdata.triangles)).reshape(-1, 3)
         adata = self._hrpapperances[sdata.appearanceIndex]
         if adata.normalPerVertex is True:
-            data.normal = numpy.array(adata.normals).reshape(len(adata.normals)/3, 3)
+            data.normal = numpy.fromiter(adata.normals, dtype=numpy.float32, count=len(adata.normals)).reshape(-1, 3)
             if len(adata.normalIndices) > 0:
-                data.normal_index = numpy.array(adata.normalIndices).reshape(len(adata.normalIndices)/3, 3)
+                data.normal_index = numpy.fromiter(adata.normalIndices, dtype=numpy.int32, count=len(adata.normalIndices)).reshape(-1, 3)
             else:
                 data.normal_index = data.vertex_index
         else:
-            data.normal = numpy.array(adata.normals).reshape(len(adata.normals)/3, 3)
+            data.normal = numpy.fromiter(adata.normals, dtype=numpy.float32, count=len(adata.normals)).reshape(-1, 3)
+            # normal per face: expand each face normal to its three vertices
             if len(adata.normalIndices) > 0:
-                idx = []
-                for i in adata.normalIndices:
-                    idx.append(i)
-                    idx.append(i)
-                    idx.append(i)
-                data.normal_index = numpy.array(idx).reshape(len(idx)/3, 3)
+                idx = numpy.fromiter(adata.normalIndices, dtype=numpy.int32, count=len(adata.normalIndices))
             else:
-                idx = []
-                for i in range(0, len(adata.normals)/3):
-                    idx.append(i)
-                    idx.append(i)
-                    idx.append(i)
-                data.normal_index = numpy.array(idx).reshape(len(idx)/3, 3)
+                idx = numpy.arange(len(adata.normals)/3, dtype=numpy.int32)
+            data.normal_index = numpy.repeat(idx, 3).reshape(-1, 3)
 #        if len(data.vertex_index) != len(data.normal_index):
 #            raise Exception('vertex length and normal length not match')
         if adata.materialIndex >= 0:
-            data.material = self._materials[adata.materialIndex]
+            data.material = self.getMaterial(adata.materialIndex)
         if data.material is not None and adata.textureIndex >= 0:
             fname = self._hrptextures[adata.textureIndex].url
             if self._assethandler:
                 data.material.texture = self._assethandler(fname)
             else:
                 data.material.texture = fname
-            data.uvmap = numpy.array(adata.textureCoordinate).reshape(len(adata.textureCoordinate)/2, 2)
-            data.uvmap_index = numpy.array(adata.textureCoordIndices).reshape(len(adata.textureCoordIndices)/3, 3)
+            data.uvmap = numpy.fromiter(adata.textureCoordinate, dtype=numpy.float32, count=len(adata.textureCoordinate)).reshape(-1, 2)
+            data.uvmap_index = numpy.fromiter(adata.textureCoordIndices, dtype=numpy.int32, count=len(adata.textureCoordIndices)).reshape(-1, 3)
+        if shapeIndex is not None:
+            self._shapecache[shapeIndex] = data
         return data
 
     def readChild(self, parent, child):
@@ -372,9 +428,38 @@ class VRMLReader(object):
 class VRMLWriter(object):
     '''
     VRML writer class
+
+    Joints whose child link cannot be found are skipped together with
+    their subtree
+
+    >>> m = model.BodyModel()
+    >>> m.name = 'sample'
+    >>> for n in ['base', 'arm']:
+    ...     l = model.LinkModel()
+    ...     l.name = n
+    ...     l.mass = 1.0
+    ...     m.links.append(l)
+    >>> for (p, c) in [('base', 'arm'), ('arm', 'ghost')]:
+    ...     j = model.JointModel()
+    ...     j.name = p + '-' + c
+    ...     j.parent = p
+    ...     j.child = c
+    ...     j.jointType = model.JointModel.J_REVOLUTE
+    ...     j.axis = model.AxisData()
+    ...     j.axis.axis = [1, 0, 0]
+    ...     m.joints.append(j)
+    >>> w = VRMLWriter()
+    >>> w.write(m, '/tmp/simtrans-sample.wrl')
+    >>> t = open('/tmp/simtrans-sample.wrl').read()
+    >>> ('base-arm' in t, 'ghost' in t)
+    (True, False)
     '''
+    _env = None
+    _templates = {}
+
     def __init__(self):
         self._linkmap = {}
+        self._childjoints = {}
         self._roots = []
         self._ignore = []
         self._options = None
@@ -431,16 +516,22 @@ class VRMLWriter(object):
         # find root joint (including local peaks)
         self._roots = utils.findroot(mdata)
 
-        # render the data structure using template
-        loader = jinja2.PackageLoader(self.__module__, 'template')
-        env = jinja2.Environment(loader=loader, extensions=['jinja2.ext.do'])
+        # map parent link name to child joints
+        self._childjoints = {}
+        for j in mdata.joints:
+            self._childjoints.setdefault(j.parent, []).append(j)
 
+        # link lookup map is rebuilt for each write (validating a cached
+        # map would need a pass over the links as well)
+        self._linkmap = {}
         self._linkmap['world'] = model.LinkModel()
         for m in mdata.links:
             self._linkmap[m.name] = m
 
-        # render shape vrml file for each links
+        # render shape vrml file for each links (files are independent
+        # with each other, so write them in parallel)
         shapefilemap = {}
+        shapetasks = {}
         for l in mdata.links:
             shapes = copy.copy(l.visuals)
             if options is not None and options.usecollision:
@@ -448,29 +539,42 @@ class VRMLWriter(object):
             if options is not None and options.useboth:
                 shapes.extend(copy.copy(l.collisions))
             for v in shapes:
-                logging.info('writing shape of link: %s, type: %s' % (l.name, v.shapeType))
                 if v.shapeType == model.ShapeModel.SP_MESH:
-                    template = env.get_template('vrml-mesh.wrl')
                     if isinstance(v.data, model.MeshTransformData):
                         v.data.pretranslate()
                     m = {}
                     m['children'] = [v.data]
                     shapefname = (mdata.name + "-" + l.name + "-" + v.name + ".wrl").replace('::', '_')
-                    with open(os.path.join(dirname, shapefname), 'w') as ofile:
-                        ofile.write(template.render({
-                            'name': v.name,
-                            'ShapeModel': model.ShapeModel,
-                            'mesh': m
-                        }))
+                    shapetasks[os.path.join(dirname, shapefname)] = (l.name, v.shapeType, {
+                        'name': v.name,
+                        'ShapeModel': model.ShapeModel,
+                        'mesh': m
+                    })
                     shapefilemap[v.name] = shapefname
+        if len(shapetasks) > 0:
+            # get the template before starting the threads (template
+            # cache is not guarded against concurrent initialization)
+            template = self.gettemplate('vrml-mesh.wrl')
+            writeshape = functools.partial(self.writeshape, template)
+            nthreads = min(len(shapetasks), multiprocessing.cpu_count())
+            if nthreads <= 1:
+                for task in shapetasks.items():
+                    writeshape(task)
+            else:
+                pool = ThreadPool(nthreads)
+                try:
+                    pool.map(writeshape, shapetasks.items())
+                finally:
+                    pool.close()
+                    pool.join()
 
         # render main vrml file for each bodies
-        template = env.get_template('vrml.wrl')
+        template = self.gettemplate('vrml.wrl')
         roots = []
         modelfiles = {}
         for root in self._roots:
             if root == 'world':
-                for r in utils.findchildren(mdata, root):
+                for r in self.findchildren(root):
                     roots.append((r.child, "fixed"))
             else:
                 roots.append((root, "free"))
@@ -484,30 +588,75 @@ class VRMLWriter(object):
             modelfiles[mfname] = self._linkmap[r[0]]
         
         # render openhrp project
-        template = env.get_template('openhrp-project.xml')
+        template = self.gettemplate('openhrp-project.xml')
         with open(fname.replace('.wrl', '-project.xml'), 'w') as ofile:
             ofile.write(template.render({
                 'models': modelfiles,
             }))
 
         # render choreonoid project
-        template = env.get_template('choreonoid-project.yaml')
+        template = self.gettemplate('choreonoid-project.yaml')
         with open(fname.replace('.wrl', '-project.cnoid'), 'w') as ofile:
             ofile.write(template.render({
                 'models': modelfiles,
             }))
 
+    @classmethod
+    def gettemplate(cls, name):
+        '''
+        Get compiled template (environment and templates are shared among writers)
+        '''
+        try:
+            return cls._templates[name]
+        except KeyError:
+            pass
+        if cls._env is None:
+            loader = jinja2.PackageLoader(__name__, 'template')
+            cls._env = jinja2.Environment(loader=loader, extensions=['jinja2.ext.do'],
+                                          cache_size=-1, auto_reload=False,
+                                          bytecode_cache=cls.getbytecodecache())
+        template = cls._env.get_template(name)
+        cls._templates[name] = template
+        return template
+
+    @staticmethod
+    def getbytecodecache():
+        '''
+        Get on-disk cache of compiled templates (reused across processes)
+        '''
+        cachehome = os.environ.get('XDG_CACHE_HOME') or os.path.join('~', '.cache')
+        cachedir = os.path.join(os.path.expanduser(cachehome), 'simtrans', 'jinja')
+        try:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+        except OSError:
+            logging.info("unable to create template cache directory %s" % cachedir)
+            return None
+        if not os.access(cachedir, os.W_OK):
+            logging.info("template cache directory %s is not writable" % cachedir)
+            return None
+        return TemplateBytecodeCache(directory=cachedir)
+
+    def writeshape(self, template, task):
+        shapefname, (linkname, shapeType, context) = task
+        logging.info('writing shape of link: %s, type: %s' % (linkname, shapeType))
+        with open(shapefname, 'w') as ofile:
+            ofile.write(template.render(context))
+
     def convertchildren(self, mdata, pjoint, joints, links):
         children = []
         plink = self._linkmap[pjoint.child]
-        for cjoint in utils.findchildren(mdata, pjoint.child):
-            nmodel = {}
-            try:
-                clink = self._linkmap[cjoint.child]
-            except KeyError:
+        pjointinv = None
+        for cjoint in self.findchildren(pjoint.child):
+            if cjoint.child not in self._linkmap:
+                # prune the subtree (nothing can be rendered below it)
                 logging.warning("unable to find child link %s" % cjoint.child)
+                continue
+            nmodel = {}
+            clink = self._linkmap[cjoint.child]
             (cchildren, joints, links) = self.convertchildren(mdata, cjoint, joints, links)
-            pjointinv = numpy.linalg.pinv(pjoint.getmatrix())
+            if pjointinv is None:
+                pjointinv = numpy.linalg.pinv(pjoint.getmatrix())
             cjointinv = numpy.linalg.pinv(cjoint.getmatrix())
             cjoint2 = copy.deepcopy(cjoint)
             cjoint2.matrix = numpy.dot(pjointinv, cjoint.getmatrix())
@@ -531,6 +680,9 @@ class VRMLWriter(object):
             links.append(cjoint.child)
         return (children, joints, links)
 
+    def findchildren(self, linkname):
+        return self._childjoints.get(linkname, [])
+
     def renderchildren(self, mdata, root, jointtype, fname, shapefilemap, template):
         nmodel = {}
         rootlink = self._linkmap[root]
@@ -554,11 +706,8 @@ class VRMLWriter(object):
         else:
             jointmap = {root: 0}
             jointcount = 1
-        for j in joints:
-            jointmap[j] = 0
-        for j in joints:
-            jointmap[j] = jointcount
-            jointcount = jointcount + 1
+        for i, j in enumerate(joints, jointcount):
+            jointmap[j] = i
 
         with open(fname, 'w') as ofile:
             ofile.write(template.render({
@@ -604,9 +753,7 @@ class VRMLMeshWriter(object):
         dirname = os.path.dirname(fname)
 
         # render the data structure using template
-        loader = jinja2.PackageLoader(self.__module__, 'template')
-        env = jinja2.Environment(loader=loader, extensions=['jinja2.ext.do'])
-        template = env.get_template('vrml-mesh.wrl')
+        template = VRMLWriter.gettemplate('vrml-mesh.wrl')
         if m.shapeType == model.ShapeModel.SP_MESH:
             if isinstance(m.data, model.MeshTransformData):
                 m.data.pretranslate()